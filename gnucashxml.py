@@ -19,8 +19,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import calendar
+import datetime
 import decimal
+import fractions
 import gzip
+import itertools
 from dateutil.parser import parse as parse_date
 
 try:
@@ -28,6 +33,7 @@ try:
 except:
     from xml.etree import ElementTree
 from xml.etree.ElementTree import ParseError
+from xml.sax.saxutils import escape, quoteattr
 
 __version__ = "1.1"
 
@@ -39,7 +45,9 @@ class Book(object):
     a reference to the accounts, transactions, prices, and commodities.
     """
     def __init__(self, tree, guid, prices=None, transactions=None, root_account=None,
-                 accounts=None, commodities=None, slots=None):
+                 accounts=None, commodities=None, slots=None,
+                 schedxactions=None, template_transactions=None,
+                 diagnostics=None):
         self.tree = tree
         self.guid = guid
         self.prices = prices
@@ -48,6 +56,10 @@ class Book(object):
         self.accounts = accounts or []
         self.commodities = commodities or []
         self.slots = slots or {}
+        self.schedxactions = schedxactions or []
+        self.template_transactions = template_transactions or []
+        # None unless the book was parsed with validate=True
+        self.diagnostics = diagnostics
 
     def __repr__(self):
         return "<Book {}>".format(self.guid)
@@ -302,27 +314,331 @@ class Price(object):
             False
 
 
+class ScheduledTransaction(object):
+    """
+    A scheduled transaction creates copies of its template transactions
+    on the dates given by its recurrences.
+
+    The template splits are in template_account; the real account and
+    amount of each are in its "sched-xaction" slot.
+    """
+    def __init__(self, guid=None, name=None, enabled=True,
+                 auto_create=False, start=None, end=None, last=None,
+                 num_occur=None, rem_occur=None, instance_count=0,
+                 template_account=None, recurrences=None, slots=None):
+        self.guid = guid
+        self.name = name
+        self.enabled = enabled
+        self.auto_create = auto_create
+        self.start = start
+        self.end = end
+        self.last = last
+        self.num_occur = num_occur
+        self.rem_occur = rem_occur
+        self.instance_count = instance_count
+        self.template_account = template_account
+        self.recurrences = recurrences or []
+        self.slots = slots or {}
+
+    def __repr__(self):
+        return "<ScheduledTransaction '{}' {}...>".format(self.name,
+                                                          self.guid[:6])
+
+    def dates(self, end):
+        """
+        Return the dates of the occurrences after the last one created,
+        up to and including end.
+        """
+        return [datetime.date.fromordinal(o)
+                for o in self._ordinals(end.toordinal())]
+
+    def _ordinals(self, hi):
+        lo = self.start.toordinal()
+        if self.last is not None:
+            lo = max(lo, self.last.toordinal() + 1)
+        if self.end is not None:
+            hi = min(hi, self.end.toordinal())
+        if len(self.recurrences) == 1:
+            ordinals = self.recurrences[0]._ordinals(lo, hi)
+        else:
+            ordinals = sorted(set(o for r in self.recurrences
+                                  for o in r._ordinals(lo, hi)))
+        remaining = self.rem_occur
+        if remaining is None and self.num_occur is not None:
+            remaining = self.num_occur - self.instance_count
+        if remaining is not None:
+            ordinals = ordinals[:max(remaining, 0)]
+        return ordinals
+
+    def _schedule_key(self):
+        # Schedules with equal keys occur on the same dates
+        return (tuple((r.period_type, r.start, r.mult, r.weekend_adjust)
+                      for r in self.recurrences),
+                self.start, self.end, self.last,
+                self.num_occur, self.rem_occur, self.instance_count)
+
+    def amounts(self):
+        """
+        Return a dict of account guid => amount that one occurrence adds
+        to that account, debits positive, in the currency of the
+        template transaction.
+        """
+        amounts = {}
+        for guid, currency, amount in self._split_amounts():
+            amounts[guid] = amounts.get(guid, 0) + amount
+        return amounts
+
+    def _split_amounts(self):
+        # Generate (account guid, currency, amount) for the template splits
+        if self.template_account is None:
+            return
+        for spl in self.template_account.splits:
+            frame = spl.slots.get('sched-xaction', {})
+            guid = frame.get('account')
+            if guid is None:
+                continue
+            yield (guid, spl.transaction.currency,
+                   (frame.get('debit-numeric') or 0) -
+                   (frame.get('credit-numeric') or 0))
+
+
+# month index (year * 12 + month - 1) => (ordinal of the 1st, length)
+_MONTHS = {}
+
+
+class Recurrence(object):
+    """
+    A recurrence is one rule in the schedule of a scheduled transaction.
+
+    It occurs every mult periods from start. The period_type is one of
+    "once", "day", "week", "month", "end of month", "nth weekday",
+    "last weekday" or "year". For "month", "end of month" and "year"
+    only, weekend_adjust "back" or "forward" moves dates falling on a
+    weekend to the Friday before or the Monday after.
+    """
+    def __init__(self, period_type, start, mult=1, weekend_adjust=None):
+        self.period_type = period_type
+        self.start = start
+        self.mult = mult
+        self.weekend_adjust = weekend_adjust
+
+    def __repr__(self):
+        return "<Recurrence every {} {} from {}>".format(
+            self.mult, self.period_type, self.start)
+
+    def dates(self, start, end):
+        """Return the dates of this recurrence from start to end inclusive."""
+        return [datetime.date.fromordinal(o)
+                for o in self._ordinals(start.toordinal(), end.toordinal())]
+
+    def _ordinals(self, lo, hi):
+        first = self.start.toordinal()
+        lo = max(lo, first)
+        if lo > hi:
+            return []
+        if self.period_type == 'once':
+            return [first] if first == lo else []
+        if self.period_type in ('day', 'week'):
+            step = self.mult * (7 if self.period_type == 'week' else 1)
+            return list(range(first + -(-(lo - first) // step) * step,
+                              hi + 1, step))
+        if self.period_type not in ('month', 'end of month', 'nth weekday',
+                                    'last weekday', 'year'):
+            raise RuntimeError("Unknown recurrence period type {}".format(
+                self.period_type))
+
+        months = self.mult * (12 if self.period_type == 'year' else 1)
+        index = self.start.year * 12 + self.start.month - 1
+        lodate = datetime.date.fromordinal(lo)
+        # Skip whole periods before lo, keeping a month of slack for
+        # the weekend adjustment
+        skip = (lodate.year * 12 + lodate.month - 2 - index) // months
+        if skip > 0:
+            index += skip * months
+        adjust = None
+        if self.period_type in ('month', 'end of month', 'year'):
+            adjust = {'back': (0, 0, 0, 0, 0, -1, -2),
+                      'forward': (0, 0, 0, 0, 0, 2, 1)}.get(
+                          self.weekend_adjust)
+        day, weekday = self.start.day, self.start.weekday()
+        ordinals = []
+        while True:
+            try:
+                monthstart, length = _MONTHS[index]
+            except KeyError:
+                year, month = divmod(index, 12)
+                monthstart, length = _MONTHS[index] = (
+                    datetime.date(year, month + 1, 1).toordinal(),
+                    calendar.monthrange(year, month + 1)[1])
+            if self.period_type in ('month', 'year'):
+                o = monthstart + min(day, length) - 1
+            elif self.period_type == 'end of month':
+                o = monthstart + length - 1
+            elif self.period_type == 'nth weekday':
+                o = (monthstart + (weekday - monthstart + 1) % 7 +
+                     (day - 1) // 7 * 7)
+                if o >= monthstart + length:
+                    o -= 7
+            else:
+                o = monthstart + length - 1
+                o -= (o - 1 - weekday) % 7
+            if o - 2 > hi:
+                break
+            if adjust is not None:
+                o += adjust[(o - 1) % 7]
+            if lo <= o <= hi:
+                ordinals.append(o)
+            index += months
+        return ordinals
+
+
+class Forecast(object):
+    """
+    A forecast projects account balances into the future.
+
+    Balances are built from the actual splits in the book plus every
+    occurrence, up to end, of the book's enabled scheduled transactions
+    that has not been created yet. Only the balance of each account on
+    the dates it changes is stored.
+
+    Balances are in each account's commodity, while scheduled amounts
+    are in the currency of their template transaction and the quantity
+    they would buy is unknown. Scheduled amounts for accounts in another
+    commodity, such as stock accounts, are therefore left out.
+    """
+    def __init__(self, book, end):
+        self.end = end
+        accountdict = dict((acc.guid, acc) for acc in book.accounts)
+
+        deltas = {}
+        for acc in book.accounts:
+            accdeltas = deltas[acc] = {}
+            for spl in acc.splits:
+                o = spl.transaction.date.toordinal()
+                accdeltas[o] = accdeltas.get(o, 0) + spl.quantity
+
+        # Schedules occurring on the same dates are summed per account
+        # first, so each list of dates is generated and merged only once
+        groups = {}
+        for sx in book.schedxactions:
+            if not sx.enabled or not sx.recurrences:
+                continue
+            group = groups.setdefault(sx._schedule_key(), (sx, {}))
+            for guid, currency, amount in sx._split_amounts():
+                acc = accountdict.get(guid)
+                if acc is not None and acc.commodity == currency:
+                    group[1][acc] = group[1].get(acc, 0) + amount
+
+        hi = end.toordinal()
+        occurrences = []
+        for sx, amounts in groups.values():
+            amounts = [(acc, amount) for acc, amount in amounts.items()
+                       if amount]
+            ordinals = sx._ordinals(hi) if amounts else []
+            if ordinals:
+                occurrences.append((ordinals, amounts))
+
+        # Occurrences are summed into one list per account, indexed by
+        # day from the earliest occurrence, and only the days with a
+        # change are merged into the actual deltas
+        if occurrences:
+            base = min(ordinals[0] for ordinals, amounts in occurrences)
+            days = range(base, hi + 1)
+            projected = {}
+            for ordinals, amounts in occurrences:
+                for acc, amount in amounts:
+                    accprojected = projected.get(acc)
+                    if accprojected is None:
+                        accprojected = projected[acc] = [0] * len(days)
+                    for o in ordinals:
+                        accprojected[o - base] += amount
+            for acc, accprojected in projected.items():
+                accdeltas = deltas[acc]
+                for o in itertools.compress(days, accprojected):
+                    accdeltas[o] = (accdeltas.get(o, 0) +
+                                    accprojected[o - base])
+
+        self._series = {}
+        for acc, accdeltas in deltas.items():
+            ordinals = sorted(accdeltas)
+            self._series[acc] = (ordinals, list(itertools.accumulate(
+                accdeltas[o] for o in ordinals)))
+
+    def __repr__(self):
+        return "<Forecast until {}>".format(self.end)
+
+    def balance(self, account, date):
+        """Return the projected balance of account at the end of date."""
+        ordinals, balances = self._series.get(account, ((), ()))
+        i = bisect.bisect_right(ordinals, date.toordinal())
+        return balances[i - 1] if i else decimal.Decimal(0)
+
+    def balances(self, date):
+        """Return a dict of account => projected balance at the end of date."""
+        return dict((acc, self.balance(acc, date)) for acc in self._series)
+
+    def series(self, account):
+        """
+        Return a list of (date, balance) pairs, one for each date on
+        which the projected balance of account changes.
+        """
+        ordinals, balances = self._series.get(account, ((), ()))
+        return [(datetime.date.fromordinal(o), balance)
+                for o, balance in zip(ordinals, balances)]
+
+
+class Diagnostic(object):
+    """
+    A diagnostic is one integrity problem found while parsing.
+
+    It names the kind ("book", "account", "transaction" or "split") and
+    guid of the element with the problem, and the check that failed:
+    "count" for a gnc:count-data that does not match the elements or
+    is missing, "imbalance" for a transaction whose split values do not
+    sum to zero, "parent" for a missing or unknown act:parent and
+    "account" for a missing or unknown split:account.
+    """
+    def __init__(self, kind, guid, check, message):
+        self.kind = kind
+        self.guid = guid
+        self.check = check
+        self.message = message
+
+    def __str__(self):
+        return "{} {}: {}".format(self.kind, self.guid, self.message)
+
+    def __repr__(self):
+        return "<Diagnostic {} {} {}...>".format(self.check, self.kind,
+                                                 self.guid[:6])
+
+
 ##################################################################
 # XML file parsing
 
-def from_filename(filename):
+def from_filename(filename, validate=False):
     """Parse a GNU Cash file and return a Book object."""
     try:
         # try opening with gzip decompression
-        return parse(gzip.open(filename, "rb"))
+        return parse(gzip.open(filename, "rb"), validate)
     except IOError:
         # try opening without decompression
-        return parse(open(filename, "rb"))
+        return parse(open(filename, "rb"), validate)
 
 
 # Implemented:
 # - gnc:book
-#
-# Not implemented:
-# - gnc:count-data
-#   - This seems to be primarily for integrity checks?
-def parse(fobj):
-    """Parse GNU Cash XML data from a file object and return a Book object."""
+# - gnc:count-data => only checked when validating
+def parse(fobj, validate=False):
+    """
+    Parse GNU Cash XML data from a file object and return a Book object.
+
+    With validate, integrity problems do not raise errors but are
+    collected as Diagnostic objects in the book's diagnostics list.
+    A book with diagnostics is for auditing only: splits with an
+    unknown account have None as account, and accounts with an unknown
+    parent have None as parent and are not reachable by walk(), so
+    methods such as ledger() may fail on it.
+    """
     try:
         tree = ElementTree.parse(fobj)
     except ParseError:
@@ -331,7 +647,8 @@ def parse(fobj):
     root = tree.getroot()
     if root.tag != 'gnc-v2':
         raise ValueError("File stream was not a valid GNU Cash v2 XML file")
-    return _book_from_tree(root.find("{http://www.gnucash.org/XML/gnc}book"))
+    return _book_from_tree(root.find("{http://www.gnucash.org/XML/gnc}book"),
+                           [] if validate else None)
 
 
 # Implemented:
@@ -340,13 +657,13 @@ def parse(fobj):
 # - gnc:commodity
 # - gnc:account
 # - gnc:transaction
-#
-# Not implemented:
 # - gnc:schedxaction
 # - gnc:template-transactions
-# - gnc:count-data
-#   - This seems to be primarily for integrity checks?
-def _book_from_tree(tree):
+# - gnc:count-data => only checked when validating
+#
+# Diagnostics is a list to collect integrity problems in, or None to
+# not check for them.
+def _book_from_tree(tree, diagnostics=None):
     guid = tree.find('{http://www.gnucash.org/XML/book}id').text
 
     # Implemented:
@@ -427,7 +744,8 @@ def _book_from_tree(tree):
     accountdict = {}
     parentdict = {}
 
-    for child in tree.findall('{http://www.gnucash.org/XML/gnc}account'):
+    account_trees = tree.findall('{http://www.gnucash.org/XML/gnc}account')
+    for child in account_trees:
         parent_guid, acc = _account_from_tree(child, commoditydict)
         if acc.actype == 'ROOT':
             root_account = acc
@@ -435,7 +753,15 @@ def _book_from_tree(tree):
         parentdict[acc.guid] = parent_guid
     for acc in list(accountdict.values()):
         if acc.parent is None and acc.actype != 'ROOT':
-            parent = accountdict[parentdict[acc.guid]]
+            parent_guid = parentdict[acc.guid]
+            if diagnostics is not None and parent_guid not in accountdict:
+                diagnostics.append(Diagnostic(
+                    'account', acc.guid, 'parent',
+                    "Parent account {} not found".format(parent_guid)
+                    if parent_guid is not None else "No parent account"))
+                accounts.append(acc)
+                continue
+            parent = accountdict[parent_guid]
             acc.parent = parent
             parent.children.append(acc)
             accounts.append(acc)
@@ -445,7 +771,70 @@ def _book_from_tree(tree):
                               'transaction'):
         transactions.append(_transaction_from_tree(child,
                                                    accountdict,
-                                                   commoditydict))
+                                                   commoditydict,
+                                                   diagnostics))
+
+    # Template transactions have their own account tree, with one
+    # account per scheduled transaction holding its template splits
+    template_transactions = []
+    template_accountdict = {}
+    t = tree.find('{http://www.gnucash.org/XML/gnc}template-transactions')
+    if t is not None:
+        _commodity_find('template', 'template')
+        template_parentdict = {}
+        for child in t.findall('{http://www.gnucash.org/XML/gnc}account'):
+            parent_guid, acc = _account_from_tree(child, commoditydict)
+            template_accountdict[acc.guid] = acc
+            template_parentdict[acc.guid] = parent_guid
+        for acc in list(template_accountdict.values()):
+            parent = template_accountdict.get(template_parentdict[acc.guid])
+            if parent is not None:
+                acc.parent = parent
+                parent.children.append(acc)
+        # Damaged templates must not keep the book from loading, so
+        # template splits with an unknown account are always collected
+        # as diagnostics (thrown away unless validating) and left with
+        # no account
+        template_diagnostics = diagnostics if diagnostics is not None else []
+        for child in t.findall('{http://www.gnucash.org/XML/gnc}'
+                               'transaction'):
+            template_transactions.append(
+                _transaction_from_tree(child,
+                                       template_accountdict,
+                                       commoditydict,
+                                       template_diagnostics))
+
+    schedxactions = []
+    for child in tree.findall('{http://www.gnucash.org/XML/gnc}'
+                              'schedxaction'):
+        schedxactions.append(_schedxaction_from_tree(child,
+                                                     template_accountdict))
+
+    if diagnostics is not None:
+        # Commodities are not checked, GNU Cash does not count all
+        # the commodities it writes
+        counts = {'account': len(account_trees),
+                  'transaction': len(transactions),
+                  'schedxaction': len(schedxactions),
+                  'price': len(prices),
+                  'budget': len(tree.findall(
+                      '{http://www.gnucash.org/XML/gnc}budget'))}
+        counted = set()
+        for child in tree.findall('{http://www.gnucash.org/XML/gnc}'
+                                  'count-data'):
+            cdtype = child.get('{http://www.gnucash.org/XML/cd}type')
+            counted.add(cdtype)
+            if cdtype in counts and int(child.text) != counts[cdtype]:
+                diagnostics.append(Diagnostic(
+                    'book', guid, 'count',
+                    "Count data says {} {}, found {}".format(
+                        child.text, cdtype, counts[cdtype])))
+        # GNU Cash only leaves out the count data of zero counts
+        for cdtype, count in sorted(counts.items()):
+            if count and cdtype not in counted:
+                diagnostics.append(Diagnostic(
+                    'book', guid, 'count',
+                    "No count data for {} {}".format(count, cdtype)))
 
     slots = _slots_from_tree(
         tree.find('{http://www.gnucash.org/XML/book}slots'))
@@ -456,7 +845,10 @@ def _book_from_tree(tree):
                 root_account=root_account,
                 accounts=accounts,
                 commodities=commodities,
-                slots=slots)
+                slots=slots,
+                schedxactions=schedxactions,
+                template_transactions=template_transactions,
+                diagnostics=diagnostics)
 
 
 
@@ -487,7 +879,9 @@ def _account_from_tree(tree, commoditydict):
         commodity = None
         commodity_scu = None
     else:
-        parent_guid = tree.find(act + 'parent').text
+        parent_guid = tree.find(act + 'parent')
+        if parent_guid is not None:
+            parent_guid = parent_guid.text
         commodity_space = tree.find(act + 'commodity/' +
                                     cmdty + 'space').text
         commodity_name = tree.find(act + 'commodity/' +
@@ -510,7 +904,8 @@ def _account_from_tree(tree, commoditydict):
 # - trn:description
 # - trn:splits / trn:split
 # - trn:slots
-def _transaction_from_tree(tree, accountdict, commoditydict):
+def _transaction_from_tree(tree, accountdict, commoditydict,
+                           diagnostics=None):
     trn = '{http://www.gnucash.org/XML/trn}'
     cmdty = '{http://www.gnucash.org/XML/cmdty}'
     ts = '{http://www.gnucash.org/XML/ts}'
@@ -543,9 +938,24 @@ def _transaction_from_tree(tree, accountdict, commoditydict):
                               slots=slots)
 
     for subtree in tree.findall(trn + "splits/" + trn + "split"):
-        split = _split_from_tree(subtree, accountdict, transaction)
+        split = _split_from_tree(subtree, accountdict, transaction,
+                                 diagnostics)
         transaction.splits.append(split)
 
+    if (diagnostics is not None and
+            sum(spl.value for spl in transaction.splits)):
+        # The Decimal values may be rounded, so check the exact sum
+        imbalance = sum(fractions.Fraction(*map(int, value.text.split("/")))
+                        for value in tree.findall(
+                            trn + "splits/" + trn + "split/"
+                            "{http://www.gnucash.org/XML/split}value"))
+        if imbalance:
+            diagnostics.append(Diagnostic(
+                'transaction', guid, 'imbalance',
+                "Split values sum to {}".format(
+                    decimal.Decimal(imbalance.numerator) /
+                    decimal.Decimal(imbalance.denominator))))
+
     return transaction
 
 
@@ -558,7 +968,7 @@ def _transaction_from_tree(tree, accountdict, commoditydict):
 # - split:quantity
 # - split:account
 # - split:slots
-def _split_from_tree(tree, accountdict, transaction):
+def _split_from_tree(tree, accountdict, transaction, diagnostics=None):
     split = '{http://www.gnucash.org/XML/split}'
     ts = "{http://www.gnucash.org/XML/ts}"
 
@@ -572,8 +982,19 @@ def _split_from_tree(tree, accountdict, transaction):
         reconcile_date = parse_date(reconcile_date.text)
     value = _parse_number(tree.find(split + "value").text)
     quantity = _parse_number(tree.find(split + "quantity").text)
-    account_guid = tree.find(split + "account").text
-    account = accountdict[account_guid]
+    account_guid = tree.find(split + "account")
+    if account_guid is not None:
+        account_guid = account_guid.text
+    if diagnostics is not None and account_guid not in accountdict:
+        diagnostics.append(Diagnostic(
+            'split', guid, 'account',
+            "{}, in transaction {}".format(
+                "Account {} not found".format(account_guid)
+                if account_guid is not None else "No account",
+                transaction.guid)))
+        account = None
+    else:
+        account = accountdict[account_guid]
     slots = _slots_from_tree(tree.find(split + "slots"))
     action = tree.find(split + "action")
     if action is not None:
@@ -589,10 +1010,88 @@ def _split_from_tree(tree, accountdict, transaction):
                   transaction=transaction,
                   action=action,
                   slots=slots)
-    account.splits.append(split)
+    if account is not None:
+        account.splits.append(split)
     return split
 
 
+# Implemented:
+# - sx:id
+# - sx:name
+# - sx:enabled
+# - sx:autoCreate
+# - sx:instanceCount
+# - sx:start
+# - sx:last
+# - sx:end
+# - sx:num-occur
+# - sx:rem-occur
+# - sx:templ-acct
+# - sx:schedule / gnc:recurrence
+# - sx:slots
+#
+# Not implemented:
+# - sx:autoCreateNotify
+# - sx:advanceCreateDays
+# - sx:advanceRemindDays
+# - sx:deferredInstance
+# - sx:freqspec => schedules from before GNU Cash 2.2
+def _schedxaction_from_tree(tree, template_accountdict):
+    sx = '{http://www.gnucash.org/XML/sx}'
+
+    def _gdate(name):
+        gdate = tree.find(sx + name + "/gdate")
+        if gdate is not None:
+            return parse_date(gdate.text).date()
+
+    def _int(name):
+        num = tree.find(sx + name)
+        if num is not None:
+            return int(num.text)
+
+    guid = tree.find(sx + "id").text
+    name = tree.find(sx + "name").text
+    enabled = tree.find(sx + "enabled")
+    auto_create = tree.find(sx + "autoCreate")
+    templ_acct = tree.find(sx + "templ-acct")
+    recurrences = [_recurrence_from_tree(child) for child in
+                   tree.findall(sx + "schedule/"
+                                "{http://www.gnucash.org/XML/gnc}recurrence")]
+    return ScheduledTransaction(
+        guid=guid,
+        name=name,
+        enabled=enabled is None or enabled.text == 'y',
+        auto_create=auto_create is not None and auto_create.text == 'y',
+        start=_gdate("start"),
+        end=_gdate("end"),
+        last=_gdate("last"),
+        num_occur=_int("num-occur"),
+        rem_occur=_int("rem-occur"),
+        instance_count=_int("instanceCount") or 0,
+        template_account=(template_accountdict.get(templ_acct.text)
+                          if templ_acct is not None else None),
+        recurrences=recurrences,
+        slots=_slots_from_tree(tree.find(sx + "slots")))
+
+
+# Implemented:
+# - recurrence:mult
+# - recurrence:period_type
+# - recurrence:start
+# - recurrence:weekend_adj
+def _recurrence_from_tree(tree):
+    recurrence = '{http://www.gnucash.org/XML/recurrence}'
+
+    mult = tree.find(recurrence + "mult")
+    weekend_adjust = tree.find(recurrence + "weekend_adj")
+    return Recurrence(
+        period_type=tree.find(recurrence + "period_type").text,
+        start=parse_date(tree.find(recurrence + "start/gdate").text).date(),
+        mult=int(mult.text) if mult is not None else 1,
+        weekend_adjust=(weekend_adjust.text
+                        if weekend_adjust is not None else None))
+
+
 # Implemented:
 # - slot
 # - slot:key
@@ -628,3 +1127,197 @@ def _slots_from_tree(tree):
 def _parse_number(numstring):
     num, denum = numstring.split("/")
     return decimal.Decimal(num) / decimal.Decimal(denum)
+
+
+##################################################################
+# XML file writing
+
+_GNC_NS = "http://www.gnucash.org/XML/"
+
+# The namespace prefixes GNU Cash declares on the gnc-v2 root element.
+_NAMESPACES = ("gnc", "act", "book", "cd", "cmdty", "price", "slot",
+               "split", "sx", "trn", "ts", "fs", "bgt", "recurrence",
+               "lot", "addr", "billterm", "bt-days", "bt-prox", "cust",
+               "employee", "entry", "invoice", "job", "order", "owner",
+               "taxtable", "tte", "vendor")
+
+
+def to_filename(book, filename, compress=True, **filters):
+    """Write a Book to a GNU Cash file, gzip compressed by default.
+
+    See write() for the filters.
+    """
+    if compress:
+        fobj = gzip.open(filename, "wb")
+    else:
+        fobj = open(filename, "wb")
+    with fobj:
+        write(book, fobj, **filters)
+
+
+# Filters:
+# - start, end => transactions posted on start <= date < end
+# - account => transactions with a split in this account's subtree,
+#   plus every account those transactions, the scheduled transactions
+#   and the budgets refer to (and their ancestors)
+# - prices_since => prices dated on or after this date
+# - schedxactions => if False, leave out the scheduled transactions
+#   and their templates
+#
+# Everything else in the book (commodities, budgets, ...) is copied
+# unchanged. Scheduled transactions are copied unchanged as well, so
+# unless left out, GNU Cash will run them from their last occurrence
+# when the written file is opened, even if it archives a closed
+# period. The gnc:count-data of accounts, transactions, scheduled
+# transactions and prices is recomputed to match what is written.
+def write(book, fobj, start=None, end=None, account=None,
+          prices_since=None, schedxactions=True):
+    """Write a Book as GNU Cash v2 XML data to a binary file object.
+
+    Only the original XML the book was parsed from is written, filtered
+    by guid. Changes made to the book's objects are ignored, and a book
+    that was not parsed from a file cannot be written. The elements are
+    serialized one at a time, so the output is never held in memory as
+    a whole. Dates are datetime.date objects.
+    """
+    if book.tree is None:
+        raise ValueError("Book was not parsed from a GNU Cash XML file")
+    gnc = '{http://www.gnucash.org/XML/gnc}'
+    cd = '{http://www.gnucash.org/XML/cd}'
+    act = '{http://www.gnucash.org/XML/act}'
+    trn = '{http://www.gnucash.org/XML/trn}'
+    price = '{http://www.gnucash.org/XML/price}'
+    bgt = '{http://www.gnucash.org/XML/bgt}'
+    slot = '{http://www.gnucash.org/XML/slot}'
+    tree = book.tree
+
+    transactions = [t for t in book.transactions
+                    if (start is None or t.date.date() >= start) and
+                    (end is None or t.date.date() < end)]
+    if account is None:
+        accountguids = None
+    else:
+        subtree = [acc for acc, children, splits in account.walk()]
+        subtreeguids = set(acc.guid for acc in subtree)
+        transactions = [t for t in transactions
+                        if any(spl.account is not None and
+                               spl.account.guid in subtreeguids
+                               for spl in t.splits)]
+        # Scheduled transaction templates and budgets refer to real
+        # accounts by guid, so keep those accounts too
+        referenced = set()
+        if schedxactions:
+            for sx in book.schedxactions:
+                referenced.update(sx.amounts())
+        for budget in tree.findall(gnc + 'budget'):
+            for elt in budget.findall(bgt + 'slots/slot'):
+                referenced.add(elt.find(slot + 'key').text)
+        accountdict = dict((acc.guid, acc) for acc in book.accounts)
+        accountguids = _account_guids_with_ancestors(
+            subtree + [spl.account for t in transactions
+                       for spl in t.splits] +
+            [accountdict[guid] for guid in referenced
+             if guid in accountdict])
+    transactionguids = set(t.guid for t in transactions)
+    priceguids = set(p.guid for p in book.prices
+                     if prices_since is None or
+                     p.date.date() >= prices_since)
+
+    def keep(elt):
+        if elt.tag == gnc + 'account':
+            return (accountguids is None or
+                    elt.find(act + 'id').text in accountguids)
+        elif elt.tag == gnc + 'transaction':
+            return elt.find(trn + 'id').text in transactionguids
+        elif elt.tag == 'price':
+            return elt.find(price + 'id').text in priceguids
+        elif elt.tag in (gnc + 'schedxaction',
+                         gnc + 'template-transactions'):
+            return schedxactions
+        return True
+
+    counts = {'account': sum(1 for elt in tree.findall(gnc + 'account')
+                             if keep(elt)),
+              'transaction': len(transactionguids),
+              'schedxaction': (len(tree.findall(gnc + 'schedxaction'))
+                               if schedxactions else 0),
+              'price': len(priceguids)}
+
+    out = ['<?xml version="1.0" encoding="utf-8" ?>\n<gnc-v2']
+    for prefix in _NAMESPACES:
+        out.append('\n     xmlns:{}="{}{}"'.format(prefix, _GNC_NS, prefix))
+    out.append('>\n<gnc:count-data cd:type="book">1</gnc:count-data>\n')
+    out.append(_start_tag(tree) + '\n')
+    fobj.write(''.join(out).encode('utf-8'))
+
+    for child in tree:
+        if not isinstance(child.tag, str) or not keep(child):
+            continue
+        if (child.tag == gnc + 'count-data' and
+                child.get(cd + 'type') in counts):
+            count = counts[child.get(cd + 'type')]
+            if count:
+                fobj.write('<gnc:count-data cd:type="{}">{}'
+                           '</gnc:count-data>\n'.format(
+                               child.get(cd + 'type'), count)
+                           .encode('utf-8'))
+        elif child.tag == gnc + 'pricedb':
+            # The price database can be large, so stream it by price.
+            fobj.write((_start_tag(child) + '\n').encode('utf-8'))
+            for elt in child:
+                if isinstance(elt.tag, str) and keep(elt):
+                    out = ['  ']
+                    _element_to_xml(elt, out)
+                    out.append('\n')
+                    fobj.write(''.join(out).encode('utf-8'))
+            fobj.write('</gnc:pricedb>\n'.encode('utf-8'))
+        else:
+            out = []
+            _element_to_xml(child, out)
+            out.append('\n')
+            fobj.write(''.join(out).encode('utf-8'))
+
+    fobj.write('</{}>\n</gnc-v2>\n\n'.format(_qname(tree.tag))
+               .encode('utf-8'))
+
+
+def _account_guids_with_ancestors(accounts):
+    guids = set()
+    for acc in accounts:
+        while acc is not None and acc.guid not in guids:
+            guids.add(acc.guid)
+            acc = acc.parent
+    return guids
+
+
+def _qname(name):
+    if not name.startswith('{'):
+        return name
+    uri, local = name[1:].split('}', 1)
+    prefix = uri[len(_GNC_NS):]
+    if not uri.startswith(_GNC_NS) or prefix not in _NAMESPACES:
+        raise ValueError("Unknown XML namespace {}".format(uri))
+    return '{}:{}'.format(prefix, local)
+
+
+def _start_tag(elt):
+    return '<{}{}>'.format(_qname(elt.tag), ''.join(
+        ' {}={}'.format(_qname(key), quoteattr(value))
+        for key, value in elt.attrib.items()))
+
+
+def _element_to_xml(elt, out):
+    """Append the serialized element, without its tail, to out."""
+    start = _start_tag(elt)
+    if elt.text is None and len(elt) == 0:
+        out.append(start[:-1] + '/>')
+        return
+    out.append(start)
+    if elt.text:
+        out.append(escape(elt.text))
+    for child in elt:
+        if isinstance(child.tag, str):
+            _element_to_xml(child, out)
+        if child.tail:
+            out.append(escape(child.tail))
+    out.append('</{}>'.format(_qname(elt.tag)))